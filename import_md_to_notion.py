@@ -1,21 +1,68 @@
 import os
 import sys
 import argparse
+import asyncio
+import threading
 import time
-import copy
-from notion_client import Client
-from notion_client.errors import APIResponseError, RequestTimeoutError
-from martian import markdown_to_blocks
+import importlib.metadata
+import importlib.util
+import hashlib
+import json
+import queue
 import re
+import httpx
+from notion_client import AsyncClient
+from notion_client.errors import (
+    APIResponseError,
+    InvalidPathParameterError,
+    RequestTimeoutError,
+    build_request_error,
+    validate_request_path,
+)
+from martian import markdown_to_blocks
 
-FENCE_RE = re.compile(r"^(\s*)(```|~~~)")
-SINGLELINE_DBLDOLLAR_RE = re.compile(r"^(\s*)\$\$(.+?)\$\$\s*$")
-ONLY_DBLDOLLAR_RE = re.compile(r"^(\s*)\$\$\s*$")
+try:
+    import orjson  # optional: several times faster than json for encoding request bodies
+except ImportError:
+    orjson = None
+
+FENCE_CHARS = ("`", "~")
+# Blockquote (">") and list item markers that may come before a code fence on the same line
+CONTAINER_PREFIX_RE = re.compile(r"[ \t>]*(?:(?:[-+*]|\d{1,9}[.)])[ \t]+[ \t>]*)*")
+# "[label]: destination" lines; such definitions only resolve within the text converted with them.
+# Matches them at any indentation and inside blockquotes or list items, as they still apply to
+# the whole document there; a false positive (e.g. in indented code) only means no splitting.
+LINK_REF_DEF_RE = re.compile(r"[ \t>]*(?:(?:[-+*]|\d{1,9}[.)])[ \t]+[ \t>]*)?\[[^\]]+\]:")
 MAX_RICH_TEXT_UNITS = 2000
-
-
-def preprocess_display_math(md: str) -> str:
-    """
+# Fenced code blocks are split (in the markdown, see preprocess_display_math) at about this size
+CODE_BLOCK_SPLIT_UNITS = int(MAX_RICH_TEXT_UNITS * 0.9)
+# Batch size adapts (AIMD): +1 block after each request while the average latency stays under
+# this many seconds, halved on timeouts and payload errors. Rate limits count requests, not
+# blocks, so a 429 leaves it alone (smaller batches would only mean more requests).
+BATCH_LATENCY_TARGET = 2.0
+# Markdown is converted (and uploaded) in pieces of at least this many lines, see split_markdown_chunks
+CONVERT_CHUNK_LINES = 1000
+# Converted (and sanitized) blocks are cached per markdown piece, keyed on its content and the
+# installed martian version. Bump CACHE_VERSION whenever a change to this script would produce
+# different blocks for the same markdown. Entries unused for CACHE_MAX_AGE_DAYS are deleted.
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "md_to_notion")
+CACHE_VERSION = 4
+CACHE_MAX_AGE_DAYS = 30
+# Names of the files this script writes to the cache dir (see _cache_entry, save_cached_blocks);
+# nothing else there is ever deleted, in case --cache-dir points at a directory with other files.
+CACHE_FILE_RE = re.compile(r"[0-9a-f]{32}\.json(?:\.\d+\.tmp)?")
+try:
+    MARTIAN_VERSION = importlib.metadata.version("pymartian")
+except importlib.metadata.PackageNotFoundError:
+    MARTIAN_VERSION = "unknown"
+# One pooled HTTP client is shared by every request; HTTP/2 (needs the optional `h2` package)
+# lets concurrent batch requests multiplex over a single socket.
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=16, max_connections=16)
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def preprocess_display_math(lines):
+    r"""
     Ensures display-math written with $$...$$ becomes a standalone block by:
       - inserting a blank line before/after display math blocks when missing
       - rewriting single-line $$ expr $$ into:
@@ -23,138 +70,320 @@ def preprocess_display_math(md: str) -> str:
             expr
             $$
     Preserves indentation (important for list items).
-    Skips fenced code blocks entirely.
+    Skips fenced code blocks entirely, except that a code block longer than
+    CODE_BLOCK_SPLIT_UNITS is closed and reopened (same fence and language) so that martian
+    produces several normal-sized code blocks instead of one oversize block. Only fences that
+    are certainly fences (indented by less than 4 spaces, no list or blockquote marker) are
+    split this way; other oversize code is left to sanitize_blocks_for_notion.
+
+    Streams: takes any iterable of lines (e.g. an open file) and yields processed lines, so the
+    whole document never has to be in memory. Lines are classified with plain prefix/slice
+    checks rather than regexes.
+
+    A shorter fence inside a code block is code, not the end of the block:
+
+    >>> code = ["````md\n", "```py\n", "print()\n", "```\n"] + ["x" * 99 + "\n"] * 40 + ["````\n"]
+    >>> out = "".join(preprocess_display_math(code))
+    >>> [line for line in out.splitlines() if line.startswith("`")]
+    ['````md', '```py', '```', '````', '````md', '````', '````md', '````']
+
+    Inline code at the start of a line is not a fence, and a fence opened in a list item
+    is closed by its indented closing line; neither inserts fence lines into the prose after it:
+
+    >>> doc = ["```foo``` is inline here.\n"] + ["x" * 99 + "\n"] * 40
+    >>> list(preprocess_display_math(doc)) == doc
+    True
+    >>> doc = ["- ```py\n", "  a = 1\n", "  ```\n", "\n"] + ["x" * 99 + "\n"] * 40
+    >>> list(preprocess_display_math(doc)) == doc
+    True
     """
-    lines = md.splitlines(True)  # keep newlines
-    out = []
-
-    in_fence = False
-    fence_marker = None
-
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-
-        # Toggle fenced code blocks
-        m_fence = FENCE_RE.match(line)
-        if m_fence:
-            marker = m_fence.group(2)
-            if not in_fence:
-                in_fence = True
-                fence_marker = marker
-            elif marker == fence_marker:
-                in_fence = False
-                fence_marker = None
-
-            out.append(line)
-            i += 1
+    fence = ""  # the fence of the code block we're in, if any
+    fence_plain = False  # whether that fence's opening line was plainly a fence (see _plain_indent)
+    fence_open = fence_close = None  # lines that reopen / close the current fenced code block
+    fence_units = 0  # UTF-16 units of code in the current (possibly split) code block
+    math_indent = None  # set while copying a multi-line $$ block through its closing "$$"
+    pending_blank = None  # blank line to emit before the next line, if that line is non-blank
+    prev = ""  # last line yielded
+
+    for line in lines:
+        if pending_blank is not None:
+            # ensure blank line after math if next line is non-blank
+            if line.strip() != "":
+                yield pending_blank
+                prev = pending_blank
+            pending_blank = None
+
+        if math_indent is not None:
+            # copy through closing "$$"
+            yield line
+            prev = line
+            if line.strip() == "$$":
+                pending_blank = math_indent + "\n"
+                math_indent = None
             continue
 
-        if in_fence:
-            out.append(line)
-            i += 1
-            continue
+        body = line.lstrip() if line[:1].isspace() else line
+        prefix, fbody = _fence_body(line)
 
-        # Case 1: single-line $$...$$
-        m_single = SINGLELINE_DBLDOLLAR_RE.match(line)
-        if m_single:
-            indent = m_single.group(1)
-            expr = m_single.group(2).strip()
+        # Toggle fenced code blocks
+        if fence:
+            if _closes_fence(fbody, fence) and (not fence_plain or _plain_indent(prefix)):
+                fence = ""
+            elif fence_plain:
+                units = _utf16_units(line)
+                if fence_units and fence_units + units > CODE_BLOCK_SPLIT_UNITS:
+                    yield fence_close
+                    yield "\n"
+                    yield fence_open
+                    fence_units = 0
+                fence_units += units
+
+        elif _fence_run(fbody):
+            fence = _fence_run(fbody)
+            fence_plain = _plain_indent(prefix)
+            fence_open = line if line.endswith("\n") else line + "\n"
+            fence_close = prefix + fence + "\n"
+            fence_units = 0
+
+        elif body[:2] == "$$":
+            indent = line[: len(line) - len(body)]
+            body = body.rstrip()
+
+            # Case 1: single-line $$...$$
+            if len(body) >= 5 and body.endswith("$$"):
+                expr = body[2:-2].strip()
+
+                # ensure blank line before (preserve indent for list context)
+                if prev.strip() != "":
+                    yield indent + "\n"
+
+                # rewrite to multiline block math, one line at a time
+                prev = indent + "$$\n"
+                yield prev
+                yield indent + expr + "\n"
+                yield prev
+                pending_blank = indent + "\n"
+                continue
+
+            # Case 2: multi-line math delimited by lines that are exactly "$$"
+            if body == "$$":
+                if prev.strip() != "":
+                    yield indent + "\n"
+                yield line
+                prev = line
+                math_indent = indent
+                continue
 
-            # ensure blank line before (preserve indent for list context)
-            if out and out[-1].strip() != "":
-                out.append(indent + "\n")
+        # Default: unchanged
+        yield line
+        prev = line
 
-            # rewrite to multiline block math
-            out.append(f"{indent}$$\n")
-            out.append(f"{indent}{expr}\n")
-            out.append(f"{indent}$$\n")
 
-            # ensure blank line after if next line is non-blank
-            if i + 1 < len(lines) and lines[i + 1].strip() != "":
-                out.append(indent + "\n")
+def _fence_body(line: str) -> tuple[str, str]:
+    """
+    Split `line` into (prefix, body) for fence detection: `body` starts after the indentation
+    and any blockquote or list item markers, so that "- ```py" and "> ```" are seen as fences.
+    """
+    body = line.lstrip(" \t")
+    if body[:1] not in FENCE_CHARS and ("`" in body or "~" in body):
+        end = CONTAINER_PREFIX_RE.match(line).end()
+        if line[end : end + 1] in FENCE_CHARS:
+            body = line[end:]
+    return line[: len(line) - len(body)], body
+
+
+def _plain_indent(prefix: str) -> bool:
+    # Under 4 spaces and nothing else: a fence line with this prefix can't be indented code or
+    # belong to a list item / blockquote opened on the same line.
+    return len(prefix) < 4 and prefix.strip(" ") == ""
+
+
+def _fence_run(body: str) -> str:
+    r"""
+    The code fence opening `body` (a line without its indentation), i.e. its leading run of
+    3+ backticks or tildes, or "" if the line doesn't start with one. Per CommonMark, a
+    backtick fence's info string can't contain a backtick, so such a line is inline code.
+
+    >>> _fence_run("```py\n")
+    '```'
+    >>> _fence_run("```foo``` is inline here.\n")
+    ''
+    >>> _fence_run("~~~ `ok`\n")
+    '~~~'
+    """
+    c = body[:1]
+    if c not in FENCE_CHARS:
+        return ""
+    run = len(body) - len(body.lstrip(c))
+    if run < 3 or (c == "`" and "`" in body[run:]):
+        return ""
+    return body[:run]
+
+
+def _closes_fence(body: str, fence: str) -> bool:
+    r"""
+    Whether `body` closes a code block opened with `fence`: per CommonMark, the same character
+    repeated at least as many times, followed by nothing but whitespace.
+
+    >>> _closes_fence("```\n", "````")
+    False
+    >>> _closes_fence("`````  \n", "````")
+    True
+    >>> _closes_fence("````py\n", "````")
+    False
+    """
+    run = _fence_run(body)
+    return run[:1] == fence[:1] and len(run) >= len(fence) and body[len(run):].strip() == ""
 
-            i += 1
-            continue
 
-        # Case 2: multi-line math delimited by lines that are exactly "$$"
-        m_open = ONLY_DBLDOLLAR_RE.match(line)
-        if m_open:
-            indent = m_open.group(1)
+def has_link_reference_definitions(lines) -> bool:
+    return any("]:" in line and LINK_REF_DEF_RE.match(line) for line in lines)
 
-            if out and out[-1].strip() != "":
-                out.append(indent + "\n")
 
-            # copy through closing "$$"
-            out.append(line)
-            i += 1
-            while i < len(lines):
-                out.append(lines[i])
-                if ONLY_DBLDOLLAR_RE.match(lines[i]):
-                    i += 1
-                    break
-                i += 1
-
-            if i < len(lines) and lines[i].strip() != "":
-                out.append(indent + "\n")
+def split_markdown_chunks(lines, min_lines: int = CONVERT_CHUNK_LINES):
+    r"""
+    Group an iterable of markdown lines into consecutive pieces, each at least `min_lines`
+    lines long (except the last), that can be converted to blocks independently. A piece only
+    ends at a blank line that is outside fenced code and $$ math, and is followed by an
+    unindented line, so no block (list item continuations, indented code, ...) straddles two
+    pieces. Link reference definitions only apply within their own piece, so callers should
+    not split documents that have any (see has_link_reference_definitions).
+    With min_lines <= 0, everything is yielded as one piece.
 
-            continue
+    Fences are tracked like preprocess_display_math does, including ones opened after list
+    item or blockquote markers. A fence line indented by 4+ spaces may be indented code or a
+    fence in a nested list; past such a line, the fence state is uncertain and nothing more is
+    cut, rather than risk cutting a code block or $$ math in two.
 
-        # Default: unchanged
-        out.append(line)
-        i += 1
+    Yields (piece, longest) where `longest` is the length of the longest stretch of the piece
+    between two such boundaries: no block (hence no rich_text item) is longer than that.
 
-    return "".join(out)
+    >>> md = "- ```py\n  a = 1\n  ```\n\ntext\n\n```\nx = 1\n\ny = 2\n```\n\nend\n"
+    >>> [piece for piece, _ in split_markdown_chunks(md.splitlines(True), 1)]
+    ['- ```py\n  a = 1\n  ```\n\n', 'text\n\n', '```\nx = 1\n\ny = 2\n```\n\n', 'end\n']
+    """
+    if min_lines <= 0:
+        min_lines = float("inf")
+
+    fence = ""  # the fence of the code block we're in, if any
+    fence_plain = False  # whether that fence's opening line was plainly a fence (see _plain_indent)
+    unsure = False  # set for good once a fence line could be indented code
+    in_math = False
+    prev_blank = False
+
+    chunk = []
+    segment = 0
+    longest = 0
+    for line in lines:
+        indented = line[:1].isspace()
+
+        if prev_blank and not indented and not (fence or in_math or unsure):
+            longest = max(longest, segment)
+            segment = 0
+            if len(chunk) >= min_lines:
+                yield "".join(chunk), longest
+                chunk = []
+                longest = 0
+
+        body = line.lstrip() if indented else line
+        prefix, fbody = _fence_body(line)
+        if fence:
+            if _closes_fence(fbody, fence) and (not fence_plain or _plain_indent(prefix)):
+                fence = ""
+        elif _fence_run(fbody):
+            fence = _fence_run(fbody)
+            fence_plain = _plain_indent(prefix)
+            if not fence_plain and prefix.strip(" \t") == "":
+                unsure = True
+        elif body.rstrip() == "$$":
+            in_math = not in_math
+
+        prev_blank = body == ""
+        chunk.append(line)
+        segment += len(line)
+
+    if chunk:
+        yield "".join(chunk), max(longest, segment)
 
 
 def _utf16_units(s: str) -> int:
     # JS string length ~= number of UTF-16 code units
+    # ASCII (most markdown) is one unit per character; isascii() is a flag check, no scan or copy
+    if s.isascii():
+        return len(s)
     # utf-16-le encodes 2 bytes per code unit; no BOM in -le
     return len(s.encode("utf-16-le")) // 2
 
+def _smart_chunk_ascii(s: str, max_units: int):
+    # ASCII is one UTF-16 unit per character, so the str itself can be cut: no encode/decode
+    min_nl = int(max_units * 0.6)
+    n = len(s)
+    chunks = []
+    start = 0
+    while start < n:
+        end = min(start + max_units, n)
+        nl = s.rfind("\n", max(start, start + min_nl - 1), end)
+        if nl >= 0:
+            end = nl + 1
+        chunks.append(s[start:end])
+        start = end
+    return chunks
+
+
 def _smart_chunk_text_utf16(s: str, max_units: int = MAX_RICH_TEXT_UNITS):
     """
     Split a string into chunks whose UTF-16 code unit length <= max_units.
     Prefer splitting at newline boundaries near the end.
+    Works on the UTF-16-LE encoding (exactly 2 bytes per code unit), so all scanning is done
+    by bytes.rfind rather than a per-character Python loop. ASCII strings are cut directly.
     """
+    if s.isascii():
+        return _smart_chunk_ascii(s, max_units)
+
+    buf = s.encode("utf-16-le")
+    n = len(buf)
+    max_bytes = max_units * 2
+    min_nl_bytes = int(max_units * 0.6) * 2
     chunks = []
-    n = len(s)
     start = 0
 
     while start < n:
-        units = 0
-        i = start
-        last_nl = None
-        last_nl_units = 0
-
-        # scan forward until we hit the unit budget
-        while i < n:
-            ch = s[i]
-            ch_units = 2 if ord(ch) > 0xFFFF else 1  # surrogate-pair chars
-            if units + ch_units > max_units:
-                break
-            units += ch_units
-            if ch == "\n":
-                last_nl = i + 1
-                last_nl_units = units
-            i += 1
-
-        if i == start:
-            # Shouldn't happen (since ch_units is max 2 and max_units is 2000),
+        end = min(start + max_bytes, n)
+        if end < n and 0xDC <= buf[end + 1] <= 0xDF:
+            # next code unit is a low surrogate: don't cut a surrogate pair in half
+            end -= 2
+
+        if end == start:
+            # Shouldn't happen (a character is at most 2 units and max_units is 2000),
             # but guard anyway to avoid infinite loops.
-            i = min(start + 1, n)
+            end = min(start + 4, n)
 
-        # Prefer newline split if it's not too far back
-        if last_nl is not None and last_nl_units >= int(max_units * 0.6):
-            cut = last_nl
-        else:
-            cut = i
+        # Prefer newline split if it's not too far back. "\n" is b"\n\x00" in UTF-16-LE; only
+        # matches on a code unit boundary (even offset) count.
+        lo = max(start, start + min_nl_bytes - 2)
+        nl = buf.rfind(b"\n\x00", lo, end)
+        while nl >= 0 and nl & 1:
+            nl = buf.rfind(b"\n\x00", lo, nl + 1)
+        if nl >= 0:
+            end = nl + 2
 
-        chunks.append(s[start:cut])
-        start = cut
+        chunks.append(buf[start:end].decode("utf-16-le"))
+        start = end
 
     return chunks
 
+def _clone_rich_text(rt: dict, content: str) -> dict:
+    """
+    Copy of a text rich_text item with its content replaced. Only the levels that differ between
+    pieces are copied (a deepcopy per piece is far slower); `link` is shared, it's never mutated.
+    """
+    rt2 = dict(rt)
+    rt2["text"] = {**rt["text"], "content": content}
+    if rt.get("annotations") is not None:
+        rt2["annotations"] = dict(rt["annotations"])
+    return rt2
+
+
 def _split_rich_text_item(rt: dict):
     """
     If rt is a text rich_text item whose content is > 2000 UTF-16 units, split it.
@@ -165,74 +394,198 @@ def _split_rich_text_item(rt: dict):
 
     text_obj = rt.get("text") or {}
     content = text_obj.get("content", "")
-    if _utf16_units(content) <= MAX_RICH_TEXT_UNITS:
+    # UTF-16 units >= len(content), with equality for ASCII, so most items are decided by
+    # len() alone and only short non-ASCII content needs counting
+    if len(content) <= MAX_RICH_TEXT_UNITS and (content.isascii() or _utf16_units(content) <= MAX_RICH_TEXT_UNITS):
         return [rt]
 
     parts = _smart_chunk_text_utf16(content, MAX_RICH_TEXT_UNITS)
-    out = []
-    for part in parts:
-        rt2 = copy.deepcopy(rt)
-        rt2["text"]["content"] = part
-        out.append(rt2)
-    return out
+    return [_clone_rich_text(rt, part) for part in parts]
 
 
-def _sanitize_any(obj):
+def _format_path(path) -> tuple[int, str]:
+    # paths are built lazily as (parent, key) pairs; only offenders ever get formatted.
+    # The top-level block index is kept as an int so callers can renumber it.
+    parts = []
+    while path[0] is not None:
+        path, key = path
+        parts.append(f"[{key}]" if isinstance(key, int) else f".{key}")
+    return path[1], "".join(reversed(parts))
+
+
+def _sanitize_and_audit(blocks, offenders):
     """
-    Recursively walk dict/list structures and sanitize any `rich_text` lists found.
+    Walk dict/list structures and sanitize any `rich_text` lists found.
     This catches paragraphs, headings, list items, code blocks, callouts, etc.
+    Any split piece that is somehow still over the limit is recorded in `offenders`.
+    Uses an explicit stack, so deeply nested blocks cost no Python frames (or RecursionError).
+    Children are pushed in reverse so they pop, and offenders are recorded, in document order.
     """
-    if isinstance(obj, dict):
-        if "rich_text" in obj and isinstance(obj["rich_text"], list):
-            new_rts = []
-            for rt in obj["rich_text"]:
-                new_rts.extend(_split_rich_text_item(rt))
-            obj["rich_text"] = new_rts
-
-        for v in obj.values():
-            _sanitize_any(v)
+    stack = [(b, (None, j)) for j, b in enumerate(blocks) if isinstance(b, (dict, list))]
+    stack.reverse()
+    while stack:
+        cur, path = stack.pop()
+        if isinstance(cur, dict):
+            if "rich_text" in cur and isinstance(cur["rich_text"], list):
+                new_rts = []
+                for rt in cur["rich_text"]:
+                    parts = _split_rich_text_item(rt)
+                    if len(parts) > 1:
+                        # unsplit items are already known to be within the limit
+                        for part in parts:
+                            c = part["text"]["content"]
+                            u = _utf16_units(c)
+                            if u > MAX_RICH_TEXT_UNITS:
+                                offenders.append((*_format_path(path), len(new_rts), u, c[:120]))
+                            new_rts.append(part)
+                    else:
+                        new_rts.extend(parts)
+                cur["rich_text"] = new_rts
+
+            stack.extend((v, (path, k)) for k, v in reversed(cur.items()) if isinstance(v, (dict, list)))
 
-    elif isinstance(obj, list):
-        for item in obj:
-            _sanitize_any(item)
+        else:
+            stack.extend((cur[j], (path, j)) for j in reversed(range(len(cur))) if isinstance(cur[j], (dict, list)))
 
 
-def sanitize_blocks_for_notion(blocks: list[dict]) -> list[dict]:
-    # Modify in place, return same list for convenience
-    _sanitize_any(blocks)
-    return blocks
+def sanitize_blocks_for_notion(blocks: list[dict]) -> tuple[list[dict], list[tuple]]:
+    """
+    Split oversize rich_text items in place, in a single walk over the block tree.
+    Returns the same list for convenience, plus (block, path, index, units, preview) for any
+    rich_text item still over MAX_RICH_TEXT_UNITS, where `block` is the index in `blocks` of
+    the top-level block holding it and `path` leads from that block to the rich_text list
+    (see _offset_offenders to renumber blocks of one piece of a larger document).
+    """
+    offenders = []
+    _sanitize_and_audit(blocks, offenders)
+    return blocks, offenders
 
 
-def find_oversize_rich_text(blocks, limit=MAX_RICH_TEXT_UNITS, max_print=10):
-    offenders = []
+def _offset_offenders(offenders, offset: int) -> list[tuple]:
+    # renumber the top-level block of each offender, e.g. from piece-relative to document-wide
+    return [(block + offset, *rest) for block, *rest in offenders]
 
-    def walk(obj, path="root"):
-        if isinstance(obj, dict):
-            if "rich_text" in obj and isinstance(obj["rich_text"], list):
-                for idx, rt in enumerate(obj["rich_text"]):
-                    if rt.get("type") == "text":
-                        c = (rt.get("text") or {}).get("content", "")
-                        u = _utf16_units(c)
-                        if u > limit:
-                            offenders.append((path, idx, u, c[:120]))
-            for k, v in obj.items():
-                walk(v, f"{path}.{k}")
-        elif isinstance(obj, list):
-            for j, it in enumerate(obj):
-                walk(it, f"{path}[{j}]")
-
-    walk(blocks, "blocks")
 
+def report_oversize_rich_text(offenders, limit=MAX_RICH_TEXT_UNITS, max_print=10):
     if offenders:
         print(f"⚠️ Found {len(offenders)} rich_text items still over {limit} UTF-16 units.")
-        for o in offenders[:max_print]:
-            print("  ", o[0], "rich_text[", o[1], "] units=", o[2], "preview=", repr(o[3]))
+        for block, path, index, units, preview in offenders[:max_print]:
+            print("  ", f"blocks[{block}]{path}", "rich_text[", index, "] units=", units, "preview=", repr(preview))
     else:
         print(f"✅ No rich_text items over {limit} UTF-16 units.")
-    return offenders
 
 
-def main():
+def _cache_entry(cache_dir: str, chunk: str):
+    """
+    Cache file for a markdown piece (named by a short hash), plus the full hash stored inside
+    it to verify that the file really belongs to this piece.
+    """
+    data = f"v{CACHE_VERSION}\nmartian {MARTIAN_VERSION}\n{chunk}".encode("utf-8")
+    key = hashlib.blake2b(data, digest_size=16).hexdigest()
+    return os.path.join(cache_dir, f"{key}.json"), hashlib.blake2b(data).hexdigest()
+
+
+def load_cached_blocks(path: str, digest: str):
+    """
+    Returns (blocks, offenders, limit_errors) as saved by save_cached_blocks, or None if there
+    is no usable entry. Offenders count top-level blocks from the start of the piece.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get("digest") != digest:
+        return None
+    try:
+        os.utime(path)  # mark as used, see prune_block_cache
+    except OSError:
+        pass
+    offenders = [tuple(o) for o in entry.get("offenders", [])]
+    return entry.get("blocks"), offenders, entry.get("limit_errors", [])
+
+
+def save_cached_blocks(path: str, digest: str, blocks: list[dict], offenders=(), limit_errors=()):
+    # Best effort: a cache that can't be written just means converting again next time.
+    # The audit results are kept too, so a cache hit reports the same problems as a conversion.
+    entry = {
+        "digest": digest,
+        "blocks": blocks,
+        "offenders": list(offenders),
+        "limit_errors": [str(err) for err in limit_errors],
+    }
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"⚠️ Could not write block cache {path}: {e}")
+
+
+def prune_block_cache(cache_dir: str, max_age_days: float = CACHE_MAX_AGE_DAYS) -> int:
+    """
+    Delete cache entries that haven't been written or loaded for `max_age_days`, so that old
+    versions of edited pieces don't pile up forever. Only files named like cache entries (or
+    their temp files) are touched. Returns the number of files deleted.
+    """
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return 0
+    for name in names:
+        if not CACHE_FILE_RE.fullmatch(name):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def encode_json(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class TokenBucket:
+    """
+    Proactive rate limiter: allows `rate` requests per second on average, with bursts of up to
+    `capacity`. Waiting before each request avoids most 429s instead of reacting to them.
+    """
+
+    def __init__(self, rate: float = 3.0, capacity: int = 3):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now > self.last_refill:
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            # sleep only until the next token is due (last_refill may be in the future after a penalty)
+            await asyncio.sleep(self.last_refill - now + (1 - self.tokens) / self.rate)
+
+    def penalize(self, retry_after: float):
+        """Drain the bucket and hold off refilling for `retry_after` seconds (e.g. after a 429)."""
+        self.tokens = 0.0
+        self.last_refill = max(self.last_refill, time.monotonic() + retry_after)
+
+
+async def main():
     parser = argparse.ArgumentParser(
         description="Import a local Markdown (.md) file into a Notion page using pymartian + notion-client."
     )
@@ -247,11 +600,43 @@ def main():
         help="Target Notion page ID (with or without hyphens). Can get this from the shareable link of a page",
     )
     parser.add_argument("--token-env", default="NOTION_TOKEN", help="Env var for Notion token (default: NOTION_TOKEN)")
-    parser.add_argument("--batch-size", type=int, default=50, help="Blocks per request (max: 50)")
-    parser.add_argument("--sleep", type=float, default=0.35, help="Sleep between successful requests (default: 0.35s)")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=50,
+        help="Initial blocks per request (max: 100); adjusted automatically from request latency",
+    )
+    parser.add_argument("--rate", type=float, default=3.0, help="Average requests per second (default: 3, Notion's rate limit)")
+    parser.add_argument("--sleep", type=float, default=None, help="Deprecated, use --rate. SLEEP means --rate 1/SLEEP; 0 means no throttling")
     parser.add_argument("--start", type=int, default=0, help="Skip the first N blocks (useful to resume)")
     parser.add_argument("--max-retries", type=int, default=2, help="Max retries on transient failures (default: 2)")
-    parser.add_argument("--skip-bad-blocks", action="store_true", default=False, help="Skip a single bad block instead of aborting")
+    parser.add_argument(
+        "--skip-bad-blocks",
+        action="store_true",
+        default=False,
+        help="Skip a single bad block instead of aborting (still aborts after --max-retries bad blocks in a row)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Batches in flight at once (default: 1). Values above 1 upload faster, but Notion appends "
+        "each batch as it arrives, so batches may land on the page out of order",
+    )
+    parser.add_argument(
+        "--chunk-lines",
+        type=int,
+        default=CONVERT_CHUNK_LINES,
+        help=f"Convert the markdown in pieces of at least this many lines (default: {CONVERT_CHUNK_LINES}). "
+        "Use 0 to convert the whole file at once. Files with link reference definitions ([label]: url) "
+        "are always converted whole so the references resolve",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=CACHE_DIR,
+        help=f"Where converted blocks are cached between runs (default: {CACHE_DIR})",
+    )
+    parser.add_argument("--no-cache", action="store_true", default=False, help="Always convert; don't read or write the block cache")
 
     args = parser.parse_args()
 
@@ -259,16 +644,39 @@ def main():
         print("Error: --batch-size must be between 1 and 100.")
         sys.exit(1)
 
+    if args.sleep is not None:
+        if args.sleep < 0:
+            print("Error: --sleep is deprecated and must not be negative; use --rate (requests per second) instead.")
+            sys.exit(1)
+        # --sleep 0 never waited; an infinite rate keeps the bucket full (429s still back off)
+        args.rate = 1 / args.sleep if args.sleep > 0 else float("inf")
+        print(f"⚠️ --sleep is deprecated; using --rate {args.rate:g}.")
+
+    if args.rate <= 0:
+        print("Error: --rate must be positive.")
+        sys.exit(1)
+
+    if args.concurrency < 1:
+        print("Error: --concurrency must be at least 1.")
+        sys.exit(1)
+
+    # append_batch() builds the request path itself, so check it the way the client would have
+    children_path = f"blocks/{args.page_id}/children"
+    try:
+        validate_request_path(children_path)
+    except InvalidPathParameterError as e:
+        print(f"Error: invalid --page-id: {e}")
+        sys.exit(1)
+
     token_env = args.token_env
     if token_env not in os.environ:
         print(f"Error: environment variable {token_env} is not set. Example: export {token_env}='secret_...'")
         sys.exit(1)
 
-    notion = Client(auth=os.environ[token_env])
-
-    with open(args.md_path, "r", encoding="utf-8") as f:
-        md = f.read()
-    md = preprocess_display_math(md)
+    notion = AsyncClient(
+        auth=os.environ[token_env],
+        client=httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=HTTP_LIMITS),
+    )
 
     limit_errors = []
     def on_limit_error(err):
@@ -284,42 +692,183 @@ def main():
         }
     }
 
-    blocks = markdown_to_blocks(md, options)   # note: pass options as 2nd positional arg
-    blocks = sanitize_blocks_for_notion(blocks)
-    find_oversize_rich_text(blocks)
-    total = len(blocks)
-    print(f"\nConverted markdown -> {total} blocks")
-
-    print("  limit_errors:", len(limit_errors))
-    for err in limit_errors:
-        print(f"    {err}")
-    print("  last_block_type:", blocks[-1].get("type"))
-    print("  last_block_preview:", str(blocks[-1])[:300])
-
-    start = max(0, min(args.start, total))
-    i = start
-    batch_size = args.batch_size
-
-    def append_batch(children):
-        notion.blocks.children.append(block_id=args.page_id, children=children)
-
-    while i < total:
-        # Never exceed Notion's max 100 children array limit. :contentReference[oaicite:5]{index=5}
-        batch_size = min(batch_size, 100)
-        batch = blocks[i : i + batch_size]
+    # Convert piece by piece in a background thread while earlier pieces are being uploaded; the
+    # bounded queue keeps only a few converted pieces waiting in memory.
+    converted = 0
+    last_block = None
+    offenders = []
 
+    cache_hits = 0
+
+    def convert_pieces():
+        nonlocal converted, last_block, cache_hits
+        if not args.no_cache:
+            pruned = prune_block_cache(args.cache_dir)
+            if pruned:
+                print(f"ℹ️ Removed {pruned} block cache entries unused for {CACHE_MAX_AGE_DAYS} days.")
+        chunk_lines = args.chunk_lines
+        if chunk_lines > 0:
+            with open(args.md_path, "r", encoding="utf-8") as f:
+                if has_link_reference_definitions(f):
+                    print("ℹ️ Found link reference definitions; converting the whole file at once so they resolve.")
+                    chunk_lines = 0
+
+        with open(args.md_path, "r", encoding="utf-8") as f:
+            for chunk, longest in split_markdown_chunks(preprocess_display_math(f), chunk_lines):
+                cached = None
+                if not args.no_cache:
+                    cache_path, cache_digest = _cache_entry(args.cache_dir, chunk)
+                    cached = load_cached_blocks(cache_path, cache_digest)
+
+                if cached is not None:
+                    cache_hits += 1
+                    blocks, chunk_offenders, chunk_limit_errors = cached
+                    for err in chunk_limit_errors:
+                        on_limit_error(err)
+                else:
+                    first_limit_error = len(limit_errors)
+                    blocks = markdown_to_blocks(chunk, options)   # note: pass options as 2nd positional arg
+                    chunk_offenders = []
+                    # Each character is at most 2 UTF-16 units and no rich_text item is longer than the
+                    # longest stretch between block boundaries, so most pieces can skip the tree walk.
+                    if longest * 2 > MAX_RICH_TEXT_UNITS:
+                        blocks, chunk_offenders = sanitize_blocks_for_notion(blocks)
+                    if not args.no_cache:
+                        save_cached_blocks(
+                            cache_path,
+                            cache_digest,
+                            blocks,
+                            chunk_offenders,
+                            limit_errors[first_limit_error:],
+                        )
+
+                # offenders are numbered within the piece (also in the cache); renumber them here only
+                offenders.extend(_offset_offenders(chunk_offenders, converted))
+                converted += len(blocks)
+                if blocks:
+                    last_block = blocks[-1]
+                yield blocks
+
+    # A thread-safe queue, so the converter thread never touches the event loop (which may
+    # already be closed when it finishes a piece). `stop` is set once the upload is over, for
+    # whatever reason; the converter then quits without enqueueing anything more.
+    loop = asyncio.get_running_loop()
+    pieces = queue.Queue(maxsize=4)
+    stop = threading.Event()
+
+    def hand_over(item) -> bool:
+        # wait for room in the queue, giving up as soon as the upload has stopped
+        while not stop.is_set():
+            try:
+                pieces.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        # None marks the end of the document; an exception is handed over to be re-raised
+        try:
+            for blocks in convert_pieces():
+                if not hand_over(blocks) or stop.is_set():
+                    return
+            item = None
+        except BaseException as e:
+            item = e
+        hand_over(item)
+
+    async def next_piece():
+        # Wait in a worker thread, a little at a time, so that an interrupted upload never
+        # leaves a thread blocked on the queue (asyncio.run() waits for its worker threads).
+        while True:
+            try:
+                return await loop.run_in_executor(None, pieces.get, True, 0.1)
+            except queue.Empty:
+                pass
+
+    start = max(0, args.start)
+    # Never exceed Notion's max 100 children array limit. :contentReference[oaicite:5]{index=5}
+    batch_size = min(args.batch_size, 100)
+    latency = None  # moving average of successful request latency (seconds)
+
+    def on_batch_success(elapsed):
+        nonlocal batch_size, latency
+        latency = elapsed if latency is None else 0.8 * latency + 0.2 * elapsed
+        if latency < BATCH_LATENCY_TARGET:
+            batch_size = min(100, batch_size + 1)
+
+    def shrink_batch_size():
+        nonlocal batch_size
+        batch_size = max(1, batch_size // 2)
+
+    async def iter_batches():
+        i = start
+        to_skip = start
+        batch = []
+        while (blocks := await next_piece()) is not None:
+            if isinstance(blocks, BaseException):
+                raise blocks
+            if to_skip:
+                skipped = min(to_skip, len(blocks))
+                blocks = blocks[skipped:]
+                to_skip -= skipped
+            for block in blocks:
+                batch.append(block)
+                if len(batch) >= batch_size:
+                    yield i, batch
+                    i += len(batch)
+                    batch = []
+        if batch:
+            yield i, batch
+
+    appended = 0
+    bad_blocks = 0  # blocks skipped with --skip-bad-blocks
+    rejected_in_a_row = 0  # single blocks rejected since the last successful append
+    bucket = TokenBucket(rate=args.rate)
+
+    async def append_batch(body: bytes):
+        # Same request as notion.blocks.children.append(), but with the JSON body encoded by us
+        # (once per batch, see upload()) instead of by httpx on every attempt.
+        try:
+            response = await notion.client.patch(
+                children_path,
+                content=body,
+                headers={"Content-Type": "application/json"},
+            )
+        except httpx.TimeoutException:
+            raise RequestTimeoutError()
+        if not response.is_success:
+            raise build_request_error(response, response.text)
+
+    async def upload(i, batch, split=False):
+        """
+        Append `batch` (whose first block is blocks[i]), retrying transient failures.
+        On validation/payload errors the batch is split in half and each half is appended in order
+        (with split=True). The shared batch size is halved once for the failing batch, not again
+        at every level of splitting, so one bad block doesn't slow down the rest of the upload.
+        Splitting only isolates the bad block(s); once more than --max-retries single blocks in a
+        row have been rejected, the page itself is the likely problem (archived, not shared with
+        the integration, ...) and we give up instead of trying every block on its own.
+        """
+        nonlocal appended, bad_blocks, rejected_in_a_row
+        body = encode_json({"children": batch})
         retries = 0
         while True:
             try:
-                append_batch(batch)
-                i += len(batch)
-                print(f"✅ Appended {i}/{total} blocks")
-                time.sleep(args.sleep)
-                break
+                await bucket.acquire()
+                t0 = time.perf_counter()
+                await append_batch(body)
+                on_batch_success(time.perf_counter() - t0)
+                appended += len(batch)
+                rejected_in_a_row = 0
+                print(f"✅ Appended {start + appended} blocks")
+                return
 
             except APIResponseError as e:
+                status, code = e.status, e.code
+
                 # Rate limit: honor Retry-After header if present. :contentReference[oaicite:6]{index=6}
-                if getattr(e, "status", None) == 429 or getattr(e, "code", "") == "rate_limited":
+                if status == 429 or code == "rate_limited":
                     retry_after = None
                     try:
                         retry_after = int(e.headers.get("Retry-After"))
@@ -327,42 +876,86 @@ def main():
                         retry_after = None
                     wait = retry_after if retry_after is not None else min(2 ** retries, 30)
                     print(f"⏳ Rate limited. Waiting {wait}s then retrying...")
-                    time.sleep(wait)
+                    # the next acquire() (from any in-flight batch) waits out the penalty
+                    bucket.penalize(wait)
                     retries += 1
                     if retries > args.max_retries:
                         raise
                     continue
 
-                # Validation/payload issues: shrink batch and retry (often fixes 500KB payload issues). :contentReference[oaicite:7]{index=7}
-                if getattr(e, "status", None) == 400 or getattr(e, "code", "") == "validation_error":
+                # Validation/payload issues: split batch and retry (often fixes 500KB payload issues). :contentReference[oaicite:7]{index=7}
+                elif status == 400 or code == "validation_error":
                     if len(batch) == 1:
                         msg = f"❌ Block {i} failed validation: {str(e)} (type={batch[0].get('type')})"
-                        if args.skip_bad_blocks:
+                        rejected_in_a_row += 1
+                        if rejected_in_a_row > args.max_retries:
+                            msg += f" ({rejected_in_a_row} blocks in a row were rejected, giving up)"
+                        elif args.skip_bad_blocks:
                             print(msg + " — skipping it.")
-                            i += 1
-                            break
+                            bad_blocks += 1
+                            return
                         raise RuntimeError(msg) from e
 
-                    batch_size = max(1, batch_size // 2)
-                    batch = blocks[i : i + batch_size]
-                    print(f"⚠️ Validation/payload error. Reducing batch size to {batch_size} and retrying...")
-                    retries += 1
-                    if retries > args.max_retries:
-                        raise
-                    continue
+                    half = len(batch) // 2
+                    if not split:
+                        shrink_batch_size()
+                    print(f"⚠️ Validation/payload error. Splitting batch at block {i} into {half} + {len(batch) - half} and retrying...")
+                    await upload(i, batch[:half], split=True)
+                    await upload(i + half, batch[half:], split=True)
+                    return
 
                 # Other API errors
                 raise
 
             except RequestTimeoutError:
                 wait = min(2 ** retries, 30)
-                print(f"⏳ Request timed out. Waiting {wait}s then retrying...")
-                time.sleep(wait)
+                shrink_batch_size()
+                print(f"⏳ Request timed out. Waiting {wait}s then retrying (batch size now {batch_size})...")
+                await asyncio.sleep(wait)
                 retries += 1
                 if retries > args.max_retries:
                     raise
 
-    print(f"🎉 Done. Appended {total - start} blocks to page {args.page_id} (skipped first {start}).")
+    # Acquire a slot *before* starting each batch so that batches start in document order and
+    # at most `concurrency` are in flight. With the default of 1 this is strictly sequential.
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def bounded(i, batch):
+        try:
+            await upload(i, batch)
+        finally:
+            semaphore.release()
+
+    threading.Thread(target=produce, name="convert", daemon=True).start()
+
+    in_flight = set()
+    try:
+        async for i, batch in iter_batches():
+            await semaphore.acquire()
+            for task in [t for t in in_flight if t.done()]:
+                in_flight.discard(task)
+                task.result()  # re-raise a failed batch before sending any more
+            in_flight.add(asyncio.create_task(bounded(i, batch)))
+        await asyncio.gather(*in_flight)
+    finally:
+        stop.set()
+        await notion.aclose()
+
+        # Printed even when the upload fails: the oversize / limit reports often explain why.
+        print(f"\nConverted markdown -> {converted} blocks")
+        if cache_hits:
+            print(f"  pieces loaded from cache: {cache_hits} ({args.cache_dir})")
+        report_oversize_rich_text(offenders)
+        print("  limit_errors:", len(limit_errors))
+        for err in limit_errors:
+            print(f"    {err}")
+        if last_block is not None:
+            print("  last_block_type:", last_block.get("type"))
+            print("  last_block_preview:", str(last_block)[:300])
+
+    print(f"🎉 Done. Appended {appended} blocks to page {args.page_id} (skipped first {min(start, converted)}).")
+    if bad_blocks:
+        print(f"⚠️ Skipped {bad_blocks} bad block(s) (see the ❌ lines above).")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())